@@ -39,6 +39,12 @@ const doi_field = "customfield_10396";
 const depositor_name_field = "customfield_10398";
 const curation_status_field = "customfield_10403";
 
+// Whether the DOI field is searchable in JQL.  Jira indexes custom
+// fields only if so configured in the field's search template; if
+// not, set this to false to fall back to downloading all curation
+// issues.
+const doi_field_searchable = true;
+
 // Functions
 
 async function api_call(method, url, success_code, data) {
@@ -84,15 +90,13 @@ async function get_curation_issues() {
             {
                 jql: "project=RDS and issuetype=Curation",
                 startAt: start.toString(),
+                maxResults: "100",
                 fields: ["status", doi_field].join(",")
             }
         );
         const r = await api_call("GET", "/search?" + query, 200);
         const j = JSON.parse(await text_content_fn(r));
         try {
-            if (j.issues.length == 0) {
-                break;
-            }
             issues.push(...
                 j.issues.map(i => {
                     return {
@@ -102,7 +106,14 @@ async function get_curation_issues() {
                     }
                 })
             );
-            start += j.issues.length;
+            const n = j.issues.length;
+            start += n;
+            // Stop on a short page rather than fetching an empty one.
+            // Jira may cap the page size below what was requested, so
+            // compare against the page size it reports.
+            if (n == 0 || n < j.maxResults || start >= j.total) {
+                break;
+            }
         } catch (e) {
             throw new Error(
                 `API unexpected response, ${e}, ${JSON.stringify(j)}`
@@ -112,6 +123,54 @@ async function get_curation_issues() {
     return issues;
 }
 
+async function get_curation_issue_by_doi(doi) {
+    // Returns the curation issue having the given DOI, or undefined.
+    let issues;
+    if (doi_field_searchable) {
+        const doi_field_id = doi_field.split("_")[1];
+        const query = encode_query_string(
+            {
+                jql: (
+                    "project=RDS and issuetype=Curation "
+                    + `and cf[${doi_field_id}] ~ "\\"${doi}\\""`
+                ),
+                maxResults: "50",
+                fields: ["status", doi_field].join(",")
+            }
+        );
+        const r = await api_call("GET", "/search?" + query, 200);
+        const j = JSON.parse(await text_content_fn(r));
+        try {
+            issues = j.issues.map(i => {
+                return {
+                    key: check_defined(i.key),
+                    status: check_defined(i.fields.status.name),
+                    doi: check_defined(i.fields[doi_field])
+                }
+            });
+        } catch (e) {
+            throw new Error(
+                `API unexpected response, ${e}, ${JSON.stringify(j)}`
+            );
+        }
+        // The exact match may be any of the fuzzy matches, so all of
+        // them must have been returned.
+        if (j.total > issues.length) {
+            throw new Error("too many issues match DOI");
+        }
+    } else {
+        // Over time this will result in quadratic behavior.
+        issues = await get_curation_issues();
+    }
+    // JQL's ~ operator is a tokenized text match, so the results must
+    // be filtered for an exact match.
+    const matches = issues.filter(ci => ci.doi == doi);
+    if (matches.length > 1) {
+        throw new Error("multiple issues with same DOI");
+    }
+    return matches[0];
+}
+
 function text_to_adf_json(text) {
     // Convert text to Atlassian Document Format JSON.
     // https://developer.atlassian.com/cloud/jira/platform/apis/document/structure/
@@ -267,12 +326,7 @@ async function process_email(email_text) {
         return;
     }
     const [doi, dataset_name, depositor] = parse_submission_email(email_text);
-    // Well here's a bummer.  There seems to be no way to query Jira
-    // using JQL to find a curation issue whose DOI field matches the
-    // DOI in hand, because DOI is a custom field.  Thus we are forced
-    // to download all curation issues.  Over time this will result in
-    // quadratic behavior.
-    const ci = (await get_curation_issues()).find(ci => ci.doi == doi);
+    const ci = await get_curation_issue_by_doi(doi);
     if (ci !== undefined) {
         if (ci.status == "Waiting on Peer Review") {
             console.log(
@@ -16,97 +16,266 @@
 # https://developer.atlassian.com/cloud/jira/platform/rest/v3/intro/
 
 import collections
+import concurrent.futures
+import functools
+import itertools
 import json
+import pathlib
 import re
 import requests
+import requests.adapters
 import urllib.parse
+import urllib3
+import uuid
 import sys
 
 base_url = "https://ucsb-atlas.atlassian.net/rest/api/3"
-auth = None  # set below
+auth = None  # set by open_session
+session = None  # set by open_session
 
 dataset_name_field = "customfield_10394"
 doi_field = "customfield_10396"
 depositor_name_field = "customfield_10398"
 curation_status_field = "customfield_10403"
 
+# Whether the DOI field is searchable in JQL.  Jira indexes custom
+# fields only if so configured in the field's search template; if
+# not, set this to False to fall back to downloading all curation
+# issues.
+doi_field_searchable = True
+
+# Maximum number of API calls made concurrently.
+max_concurrent_requests = 8
+
+email_type_markers = {
+    "submission": "Your submission will soon enter our curation process.",
+    "publication": (
+        "has been reviewed by our curation team and approved "
+        + "for publication."
+    ),
+    "peer_review": (
+        "Your dataset will now remain private until your "
+        + "related manuscript has been accepted."
+    )
+}
+paragraph_separator_re = re.compile(r"\n+")
+depositor_re = re.compile(r"^Dear +([^ ].*),$", re.M)
+dataset_name_re = re.compile(
+    r"^Thank you for submitting your dataset entitled, \"(.*)\"\.$",
+    re.M
+)
+doi_re = re.compile(
+    r"^Your dataset has been assigned a unique digital object "
+    + r"identifier \(DOI\): doi:(10\.[0-9]+/[0-9A-Z]+)",
+    re.M
+)
+
+class ApiCallError(Exception):
+    # Raised when an API call returns other than the expected status.
+    pass
+
 def api_call(method, url, success_code, **kwargs):
-    headers = {
-        "Accept": "application/json"
-    }
+    headers = {}
     if "data" in kwargs:
         headers["Content-Type"] = "application/json"
-    r = requests.request(
+    r = session.request(
         method,
         base_url + url,
         headers=headers,
-        auth=auth,
         **kwargs
     )
-    assert r.status_code == success_code, (
-        f"API call failed, status code {r.status_code}, {r.text}"
-    )
+    if r.status_code != success_code:
+        raise ApiCallError(
+            f"API call failed, status code {r.status_code}, {r.text}"
+        )
     return r
 
 CurationIssue = collections.namedtuple("CurationIssue", "key status doi")
 
-def get_curation_issues():
-    # Return all existing curation issues as [CurationIssue, ...].
-    issues = []
-    start = 0
-    while True:
-        query = urllib.parse.urlencode(
-            {
-                "jql": "project=RDS and issuetype=Curation",
-                "startAt": str(start),
-                "fields": ",".join(["status", doi_field])
-            }
+def get_curation_issues_page(fields, start):
+    # Return one page of curation issues beginning at offset `start`
+    # as ([(key, {field: value, ...}), ...], page_size, total), where
+    # the fields returned are those named in `fields`.  Jira may cap
+    # the page size below what was requested, so the page size
+    # returned is the one it reports.
+    query = urllib.parse.urlencode(
+        {
+            # Pages may be fetched concurrently, so a stable ordering
+            # is needed for the offsets to neither overlap nor skip.
+            "jql": "project=RDS and issuetype=Curation order by key",
+            "startAt": str(start),
+            "maxResults": "100",
+            "fields": ",".join(fields)
+        }
+    )
+    r = api_call("GET", "/search?" + query, 200)
+    try:
+        j = r.json()
+        return (
+            [
+                (i["key"], {f: i["fields"][f] for f in fields})
+                for i in j["issues"]
+            ],
+            j["maxResults"],
+            j["total"]
         )
-        r = api_call("GET", "/search?" + query, 200)
-        try:
-            j = r.json()
-            if len(j["issues"]) == 0:
-                break
-            issues.extend(
-                CurationIssue(
-                    key=i["key"],
-                    status=i["fields"]["status"]["name"],
-                    doi=i["fields"][doi_field]
+    except:
+        raise Exception(f"API unexpected response, {r.text}")
+
+def get_curation_issues(fields):
+    # Generate all existing curation issues as (key, {field: value,
+    # ...}) tuples, where the fields returned are those named in
+    # `fields`.  Once the first page reveals the total number of
+    # issues, the remaining pages are fetched concurrently.  N.B.:
+    # requests does not guarantee that a Session is thread-safe; the
+    # workers share the module session only to issue GET requests
+    # through its connection pool, which is sized for them.  Issues
+    # are yielded in order a page at a time, and only as many pages
+    # as there are workers are requested ahead of the page being
+    # yielded, so at most that many pages are held in memory.
+    page, page_size, total = get_curation_issues_page(fields, 0)
+    yield from page
+    if len(page) == 0 or len(page) < page_size:
+        return
+    starts = iter(range(page_size, total, page_size))
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max_concurrent_requests
+    ) as executor:
+        pending = collections.deque(
+            executor.submit(get_curation_issues_page, fields, start)
+            for start in itertools.islice(starts, max_concurrent_requests)
+        )
+        while len(pending) > 0:
+            page, _, _ = pending.popleft().result()
+            for start in itertools.islice(starts, 1):
+                pending.append(
+                    executor.submit(get_curation_issues_page, fields, start)
                 )
-                for i in j["issues"]
+            yield from page
+
+def get_curation_issue(key):
+    # Return the curation issue having the given key as a
+    # CurationIssue.
+    query = urllib.parse.urlencode(
+        {
+            "fields": ",".join(["status", doi_field])
+        }
+    )
+    r = api_call("GET", f"/issue/{key}?" + query, 200)
+    try:
+        j = r.json()
+        return CurationIssue(
+            key=j["key"],
+            status=j["fields"]["status"]["name"],
+            doi=j["fields"][doi_field]
+        )
+    except:
+        raise Exception(f"API unexpected response, {r.text}")
+
+def get_curation_version():
+    # Return a token that changes whenever a curation issue is
+    # created, deleted, or updated: the number of curation issues and
+    # the most recent update time among them.
+    query = urllib.parse.urlencode(
+        {
+            "jql": "project=RDS and issuetype=Curation order by updated desc",
+            "maxResults": "1",
+            "fields": "updated"
+        }
+    )
+    r = api_call("GET", "/search?" + query, 200)
+    try:
+        j = r.json()
+        return (
+            j["total"],
+            j["issues"][0]["fields"]["updated"] if j["issues"] else None
+        )
+    except:
+        raise Exception(f"API unexpected response, {r.text}")
+
+@functools.lru_cache(maxsize=1)
+def _curation_index(version):
+    # Return all existing curation issues that have a DOI as {doi:
+    # [key, ...], ...}; a DOI normally maps to a single key.  The index
+    # is cached by `version`, as returned by get_curation_version, so
+    # it is recomputed only when some curation issue has changed,
+    # whether by this program or otherwise.  Downloading all curation
+    # issues is expensive; over time it will result in quadratic
+    # behavior.
+    index = {}
+    for key, fields in get_curation_issues([doi_field]):
+        doi = fields[doi_field]
+        if doi is not None:
+            index.setdefault(doi, []).append(key)
+    return index
+
+def get_curation_issue_by_doi(doi):
+    # Return the curation issue having the given DOI as a
+    # CurationIssue, or None.
+    if not doi_field_searchable:
+        # Only the matching issue's status is needed, so it is
+        # retrieved separately.
+        keys = _curation_index(get_curation_version()).get(doi, [])
+        assert len(keys) <= 1, f"multiple issues with DOI {doi}"
+        return get_curation_issue(keys[0]) if len(keys) > 0 else None
+    doi_field_id = doi_field.split("_")[1]
+    query = urllib.parse.urlencode(
+        {
+            "jql": (
+                "project=RDS and issuetype=Curation "
+                + f'and cf[{doi_field_id}] ~ "\\"{doi}\\""'
+            ),
+            "maxResults": "50",
+            "fields": ",".join(["status", doi_field])
+        }
+    )
+    r = api_call("GET", "/search?" + query, 200)
+    try:
+        # JQL's ~ operator is a tokenized text match, so the results
+        # must be filtered for an exact match.
+        j = r.json()
+        ci_match = [
+            CurationIssue(
+                key=i["key"],
+                status=i["fields"]["status"]["name"],
+                doi=i["fields"][doi_field]
             )
-            start += len(j["issues"])
-        except:
-            raise Exception(f"API unexpected response, {r.text}")
-    return issues
+            for i in j["issues"]
+        ]
+        total = j["total"]
+    except:
+        raise Exception(f"API unexpected response, {r.text}")
+    # The exact match may be any of the fuzzy matches, so all of them
+    # must have been returned.
+    assert total <= len(ci_match), "too many issues match DOI"
+    ci_match = [ci for ci in ci_match if ci.doi == doi]
+    assert len(ci_match) <= 1, f"multiple issues with DOI {doi}"
+    return ci_match[0] if len(ci_match) > 0 else None
 
 def text_to_adf_json(text):
-    # Convert text to Atlassian Document Format JSON.
+    # Convert text to Atlassian Document Format JSON, returned already
+    # serialized.  The structure is fixed, so only the paragraph texts
+    # need encoding.
     # https://developer.atlassian.com/cloud/jira/platform/apis/document/structure/
     line_separator = "\u2028"
+    text = text.replace(line_separator, "\n")
     paragraphs = [
-        p.strip()
-        for p in re.split(r"\n+", text.replace(line_separator, "\n"))
-        if len(p.strip()) > 0
+        p
+        for p in (s.strip() for s in paragraph_separator_re.split(text))
+        if len(p) > 0
     ]
-    return {
-        "version": 1,
-        "type": "doc",
-        "content": [
-            {
-                "type": "paragraph",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": p
-                    }
-                ]
-            }
-            for p in paragraphs
-        ]
-    }
+    content = ",".join(
+        '{"type":"paragraph","content":[{"type":"text","text":'
+        + json.dumps(p)
+        + "}]}"
+        for p in paragraphs
+    )
+    return '{"version":1,"type":"doc","content":[' + content + "]}"
 
 def create_curation_issue(email_text, doi, dataset_name, depositor):
+    # The description is already serialized, so a unique placeholder
+    # is serialized in its place and then replaced.
+    placeholder = f"description-{uuid.uuid4().hex}"
     payload = json.dumps(
         {
             "fields": {
@@ -117,7 +286,7 @@ def create_curation_issue(email_text, doi, dataset_name, depositor):
                     "name": "Curation"
                 },
                 "summary": f"Dryad curation doi:{doi}",
-                "description": text_to_adf_json(email_text),
+                "description": placeholder,
                 dataset_name_field: dataset_name,
                 doi_field: doi,
                 depositor_name_field: depositor,
@@ -125,8 +294,12 @@ def create_curation_issue(email_text, doi, dataset_name, depositor):
                     "value": "Submitted"
                 }
             }
-        }
+        },
+        separators=(",", ":")
     )
+    placeholder = json.dumps(placeholder)
+    assert payload.count(placeholder) == 1
+    payload = payload.replace(placeholder, text_to_adf_json(email_text))
     r = api_call("POST", "/issue", 201, data=payload)
     try:
         return r.json()["key"]
@@ -134,70 +307,77 @@ def create_curation_issue(email_text, doi, dataset_name, depositor):
         assert False, f"API unexpected response, {r.text}"
 
 def email_type(email_text):
-    markers = {
-        "submission": "Your submission will soon enter our curation process.",
-        "publication": (
-            "has been reviewed by our curation team and approved "
-            + "for publication."
-        ),
-        "peer_review": (
-            "Your dataset will now remain private until your "
-            + "related manuscript has been accepted."
-        )
-    }
-    matches = [t for t, m in markers.items() if m in email_text]
+    # Stop checking markers as soon as the type is known to be
+    # ambiguous.
+    matches = []
+    for t, m in email_type_markers.items():
+        if m in email_text:
+            matches.append(t)
+            if len(matches) >= 2:
+                break
     assert len(matches) >= 1, "unrecognized email message type"
     assert len(matches) == 1, "ambiguous email message type"
     return matches[0]
 
 def parse_submission_email(email_text):
-    depositor = re.search(
-        r"^Dear +([^ ].*),$",
-        email_text,
-        re.M
-    )[1].strip()
-    dataset_name = re.search(
-        r"^Thank you for submitting your dataset entitled, \"(.*)\"\.$",
-        email_text,
-        re.M
-    )[1].strip()
-    doi = re.search(
-        r"^Your dataset has been assigned a unique digital object "
-        + r"identifier \(DOI\): doi:(10\.[0-9]+/[0-9A-Z]+)",
-        email_text,
-        re.M
-    )[1]
+    depositor = depositor_re.search(email_text)[1].strip()
+    dataset_name = dataset_name_re.search(email_text)[1].strip()
+    doi = doi_re.search(email_text)[1]
     return (doi, dataset_name, depositor)
 
-def change_issue_status(key, new_status):
-    # N.B.: Status changes must obey the transitions allowed by the
-    # workflow set up in Jira.
+# Workflow transitions as {from_status: {to_status: id, ...}, ...},
+# filled in as statuses are encountered.
+_workflow_cache = {}
+
+def get_issue_transitions(key):
+    # Return the transitions currently allowed for an issue as
+    # {to_status: id, ...}.
     r = api_call("GET", f"/issue/{key}/transitions", 200)
     try:
-        id = [
-            t["id"]
-            for t in r.json()["transitions"]
-            if t["to"]["name"] == new_status
-        ][0]
-    except IndexError:
-        raise Exception("new status not found in allowable transitions")
+        return {t["to"]["name"]: t["id"] for t in r.json()["transitions"]}
     except:
         raise Exception(f"API unexpected response, {r.text}")
+
+def transition_issue(key, id):
     payload = json.dumps(
         {
             "transition": {
                 "id": id
             }
-        }
+        },
+        separators=(",", ":")
     )
     api_call("POST", f"/issue/{key}/transitions", 204, data=payload)
 
+def change_issue_status(key, new_status, current_status=None):
+    # N.B.: Status changes must obey the transitions allowed by the
+    # workflow set up in Jira.  If the issue's current status is
+    # supplied, the transitions out of that status are looked up once
+    # and cached; otherwise, they are always looked up.  A cached
+    # transition may not apply to every issue, so if it fails, the
+    # transitions are looked up again and the change is retried once.
+    if current_status is not None:
+        transitions = _workflow_cache.get(current_status, {})
+        if new_status in transitions:
+            try:
+                transition_issue(key, transitions[new_status])
+                return
+            except ApiCallError:
+                pass
+    transitions = get_issue_transitions(key)
+    if current_status is not None:
+        _workflow_cache[current_status] = transitions
+    if new_status not in transitions:
+        raise Exception("new status not found in allowable transitions")
+    transition_issue(key, transitions[new_status])
+
 def change_issue_fields(key, **kwargs):
     # `kwargs` should map field names to new values.
     payload = json.dumps(
         {
             "fields": kwargs
-        }
+        },
+        separators=(",", ":")
     )
     api_call("PUT", f"/issue/{key}", 204, data=payload)
 
@@ -206,19 +386,14 @@ def process_email(email_text):
         print("not a submission email, ignoring")
         return
     doi, dataset_name, depositor = parse_submission_email(email_text)
-    # Well here's a bummer.  There seems to be no way to query Jira
-    # using JQL to find a curation issue whose DOI field matches the
-    # DOI in hand, because DOI is a custom field.  Thus we are forced
-    # to download all curation issues.  Over time this will result in
-    # quadratic behavior.
-    ci_match = list(filter(lambda ci: ci.doi == doi, get_curation_issues()))
-    if len(ci_match) > 0:
-        ci = ci_match[0]
+    ci = get_curation_issue_by_doi(doi)
+    if ci is not None:
         if ci.status == "Waiting on Peer Review":
             print("issue already exists, is PPR, changing to To Do")
             # Must follow allowed transitions.
-            change_issue_status(ci.key, "In Progress")
-            change_issue_status(ci.key, "To Do")
+            change_issue_status(ci.key, "In Progress", ci.status)
+            ci = ci._replace(status="In Progress")
+            change_issue_status(ci.key, "To Do", ci.status)
             updates = {
                 "assignee": None,
                 curation_status_field: {
@@ -235,8 +410,41 @@ def process_email(email_text):
 
 # Processing
 
-auth = requests.auth.HTTPBasicAuth(*sys.argv[1].split(":", 1))
-process_email(open(sys.argv[2]).read())
+def open_session(credentials):
+    # Set up authenticated access to Jira; must be called before any
+    # API call.  `credentials` should be email_address:token as on
+    # the command line.  A single session is used so that the
+    # connection to Jira is reused across API calls.  Failed requests
+    # are retried only if idempotent, per urllib3's defaults.
+    global auth, session
+    auth = requests.auth.HTTPBasicAuth(*credentials.split(":", 1))
+    session = requests.Session()
+    session.auth = auth
+    session.headers["Accept"] = "application/json"
+    session.mount(
+        "https://",
+        requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=max_concurrent_requests,
+            max_retries=urllib3.Retry(
+                total=3,
+                backoff_factor=0.3,
+                status_forcelist=[429, 502, 503, 504],
+                raise_on_status=False
+            )
+        )
+    )
+
+def main():
+    open_session(sys.argv[1])
+    try:
+        email_text = pathlib.Path(sys.argv[2]).read_text(encoding="utf-8")
+    except FileNotFoundError:
+        sys.exit(f"message file not found: {sys.argv[2]}")
+    process_email(email_text)
+
+if __name__ == "__main__":
+    main()
 
 # Debugging/development aids
 